@@ -2,18 +2,19 @@
 import sys
 import argparse
 from argparse import ArgumentParser, ArgumentTypeError
-from itertools import chain, repeat, islice
+from itertools import chain, repeat, islice, accumulate
 from dataclasses import dataclass
-from typing import Iterable
+from typing import Iterable, Optional
+from xml.sax.saxutils import escape
 from drawsvg import *
 
-@dataclass
+@dataclass(slots=True)
 class MetaLine:
   "Metadata lines (key-val pairs)"
   key: str
   val: str
 
-@dataclass
+@dataclass(slots=True)
 class WordLine:
   "UD wordlines with 10 named fields"
   ID: str
@@ -30,17 +31,18 @@ class WordLine:
   def as_dict(self):
       return {
         "ID": self.ID, "FORM": self.FORM, "LEMMA": self.LEMMA,
-        "UPOS": self.POS, "XPOS": self.XPOS,
+        "UPOS": self.UPOS, "XPOS": self.XPOS,
         "FEATS": self.FEATS, "HEAD": self.HEAD, "DEPREL": self.DEPREL,
         "DEPS": self.DEPS, "MISC": self.MISC
         }
     
   def __str__(self):
-    return "\t".join(self.as_dict().values())
+    return "\t".join((
+      self.ID, self.FORM, self.LEMMA, self.UPOS, self.XPOS,
+      self.FEATS, self.HEAD, self.DEPREL, self.DEPS, self.MISC))
 
   def feats(self) -> dict:
-    featvals = [fv.split("=") for fv in self.FEATS.split("|")]
-    return {fv[0]: fv[1] for fv in featvals}
+    return dict(fv.split("=", 1) for fv in self.FEATS.split("|") if "=" in fv)
 
 STD_FIELDS = set("ID FORM LEMMA UPOS XPOS FEATS HEAD DEPREL DEPS MISC".split())
 DEFAULT_FIELDS = ["FORM", "UPOS", "HEAD", "DEPREL"]
@@ -54,9 +56,6 @@ def ifint(id: str) ->int:
   else:
       return int(float(id))  # for ids like "7.1"
 
-    
-class NotValidWordLine(Exception):
-  pass
 
 class NotValidMetaLine(Exception):
   pass
@@ -66,13 +65,15 @@ class NotValidTree(Exception):
   pass
 
 
-def read_wordline(s: str) -> WordLine:
-  "read a string as a WordLine, fail if not valid"
-  fields = s.strip().split("\t")
-  if len(fields) == 10 and fields[0][0].isdigit():
+def read_wordline(s: str) -> Optional[WordLine]:
+  "read a string as a WordLine, return None if not valid"
+  s = s.strip()
+  if not s or not s[0].isdigit(): # also rules out comments
+    return None
+  fields = s.split("\t")
+  if len(fields) == 10:
     return WordLine(*fields)
-  else:
-    raise NotValidWordLine
+  return None
 
 def read_metaline(s: str) -> MetaLine:
   if s.startswith("#") and "=" in s:
@@ -85,15 +86,16 @@ def read_metaline(s: str) -> MetaLine:
 def read_lines(lines):
   "read a sequence of strings as WordLines or MetaLines, ignoring failed ones"
   for line in lines:
-    try:
+    if not line:
+      continue
+    if line[0] == "#":
+      # only key-val comments are metadata, so skip the rest without raising
+      if "=" in line:
+        yield read_metaline(line)
+    else:
       word = read_wordline(line)
-      yield word
-    except NotValidWordLine:
-      try:
-        meta = read_metaline(line)
-        yield meta
-      except NotValidMetaLine:
-        pass
+      if word is not None:
+        yield word
 
 # default measures
 SPACE_LEN = 15
@@ -105,6 +107,11 @@ TINY_TXT_SIZE = 10
 SCALE = 5
 ARC_BASE_YPOS = 50
 
+def path_data(*commands) -> str:
+  "'d' attribute of an SVG path from (command, *coordinates) tuples"
+  return " ".join(
+    cmd + ",".join(map(str, coords)) for (cmd, *coords) in commands)
+
 class VisualStanza:
   """class to visualize a CoNNL-U stanza; partly corresponding to Dep in the
   Haskell implementation. 
@@ -123,73 +130,94 @@ class VisualStanza:
       else:
         pass
 
-    # token-wise info to be visualized
-    self.tokens = [({
-      "ID": wl.ID,
-      "FORM": wl.FORM,
-      "LEMMA": wl.LEMMA,
-      "UPOS": wl.UPOS, 
-      "XPOS": wl.XPOS
-      }) for wl in wordlines] 
+    # token-wise info to be visualized (fields are read off the WordLines)
+    self.tokens = wordlines
       
     # list of dependency relations: [((from,to), label)], cf. Dep's deps
     self.deprels = [
       ((int(wl.ID) - 1, int(wl.HEAD) - 1), wl.DEPREL) for wl in wordlines
       if int(wl.HEAD)] # 
 
+    # bare arcs (pairs of positions), ltr, extracted once from the deprels
+    self._arcs = tuple(
+      (min(src, trg), max(src, trg)) for ((src, trg),_) in self.deprels)
+
     # root position, cf. Dep's root
-    self.root = int([wl.ID for wl in wordlines if wl.HEAD == "0"][0]) - 1
-    self.root_label = [wl.DEPREL for wl in wordlines if wl.HEAD == "0"][0]
+    root_wl = next((wl for wl in wordlines if wl.HEAD == "0"), None)
+    if root_wl is None:
+      raise NotValidTree("no root (HEAD 0) wordline")
+    self.root = int(root_wl.ID) - 1
+    self.root_label = root_wl.DEPREL
+
+    # token widths and their prefix sums (start x coordinates), computed once
+    self._widths = [self._compute_width(i) for i in range(len(self.tokens))]
+    self._xpos = list(accumulate(self._widths, initial=0))
+
+    # arc heights, cf. aheight. Arcs are visited by increasing span, so that
+    # the heights of all the arcs "under" an arc are known when we get to it
+    self._arc_heights = {}
+    for (a,b) in sorted(set(self.arcs()), key=lambda arc: arc[1] - arc[0]):
+      self._arc_heights[(a,b)] = self._height(a, b)
   
-  def token_width(self, i):
-    """total i-th token width (including space) in the output SVG"""
+  def _compute_width(self, i):
+    token = self.tokens[i]
     abs_token_len = CHAR_LEN * max( # cf. Dep's wordLength
       0, 
-      len(self.tokens[i]["FORM"]), 
-      len(self.tokens[i]["LEMMA"]), 
-      len(self.tokens[i]["UPOS"]) + 
-      ((len(self.tokens[i]["XPOS"]) + 3) if "XPOS" in self.fields else 0))
+      len(token.FORM), 
+      len(token.LEMMA), 
+      len(token.UPOS) + 
+      ((len(token.XPOS) + 3) if "XPOS" in self.fields else 0))
     rel_token_len = abs_token_len / DEFAULT_WORD_LEN # cf. rwdl
     return 100 * rel_token_len + SPACE_LEN
 
+  def token_width(self, i):
+    """total i-th token width (including space) in the output SVG"""
+    return self._widths[i]
+
   def token_xpos(self, i): 
     """start x coordinate of i-th token, cf. wpos"""
-    return sum([self.token_width(j) for j in range(i)])
+    return self._xpos[i]
   
   def token_dist(self, a, b):
     """distance between two tokens with positions a and b"""
-    return sum([self.token_width(i) for i in range(min(a, b), max(a, b))])
+    return self._xpos[max(a, b)] - self._xpos[min(a, b)]
   
   def arcs(self):
-    """helper method to extract bare arcs (pairs of positions) form deprels
+    """bare arcs (pairs of positions) extracted from deprels in __init__
     NOTE: arcs are extracted ltr, but I don't know if this is really needed"""
-    return [(min(src, trg), max(src, trg)) for ((src, trg),_) in self.deprels]
+    return self._arcs
+
+  def _height(self, a, b):
+    # 1 + the height of the highest projective arc "under" a-b
+    return 1 + max([0] + [h for ((x,y),h) in self._arc_heights.items() 
+                          if (a < x and y <= b) or (a == x and y < b)])
 
   def arc_height(self, src, trg):
     """height of the arc between src and trg, cf. aheight"""
-
-    def depth(a,b):
-      # projective arcs "under" a-b
-      sub_arcs = [(x,y) for (x,y) in self.arcs() 
-                  if (a < x and y <= b) or (a == x and y < b)]
-      if sub_arcs:
-        return 1 + max([0] + [depth(x,y) for (x,y) in sub_arcs]) 
-      return 0
-    
-    return depth(min(src,trg), max(src,trg)) + 1
+    a, b = min(src,trg), max(src,trg)
+    if (a,b) in self._arc_heights:
+      return self._arc_heights[(a,b)]
+    return self._height(a, b)
   
-  def to_svg(self, color="white"):
-    """generate svg tree code"""
-    tokens_w = sum([self.token_width(i) for i in range(len(self.tokens))])
-
-    # picture dimensions 
-    tot_w = tokens_w
+  def _dimensions(self):
+    """total width and height of the output SVG"""
+    tot_w = self._xpos[-1] # total width of all the tokens
     tot_h = 55 + 30 * max([1] + [self.arc_height(src,trg) 
                                  for (src,trg) in self.arcs()])
+    return tot_w, tot_h
+
+  def _elements(self, tot_w, tot_h):
+    """SVG primitives making up a tree of the given dimensions, shared by
+    to_svg and to_svg_str:
+    ("text", txt, size, x, y, font_style, font_weight) and ("path", d, fill)
+    tuples, where fill is either "none", "stroke" (same as the stroke color)
+    or None (unspecified)"""
+    fields = self.fields
+    xpos_table = self._xpos
+    arc_heights = self._arc_heights
     
     # otherwise everything will be mirrored
     ycorrect = lambda y: (round(tot_h)) - round(y) - 5
-    svg = Drawing(tot_w,tot_h, origin=(0,0))
 
     def highlighted(txt: str):
       return txt.startswith("*") and txt.endswith("*")
@@ -198,59 +226,53 @@ class VisualStanza:
       txt: str, 
       size: int, 
       x: float, y: float, 
-      color: str="black",
-      style="normal") -> Text:
+      style="normal") -> tuple:
       
         bold = False
         if highlighted(txt): 
           txt = txt.replace("*", "")
           bold = True
       
-        return Text(
-          txt, 
-          size, 
-          x=x, y=y, 
-          fill=color, 
-          font_style=style, font_weight="bold" if bold else "normal"
-        )
+        return ("text", txt, size, x, y, style, "bold" if bold else "normal")
     
     # draw tokens (forms + pos tags)
     for (i,token) in enumerate(self.tokens):
-      x = self.token_xpos(i)
-      upos = token["UPOS"]
-      xpos = token["XPOS"]
+      x = xpos_table[i]
+      upos = token.UPOS
+      xpos = token.XPOS
       pos = " - ".join(
         [pos for pos in [
-          upos if "UPOS" in self.fields else None, 
-          xpos if "XPOS" in self.fields else None] 
+          upos if "UPOS" in fields else None, 
+          xpos if "XPOS" in fields else None] 
         if pos]
       )
       if highlighted(upos) or highlighted(xpos):
         # if either is highlighted, remove *s and higlight POS as a whole
         pos.replace("*", "")
         pos = "*{}*".format(pos)
-      form = token["FORM"]
-      lemma = token["LEMMA"]
-      id = token["ID"]
-
-      if "UPOS" in self.fields or "XPOS" in self.fields:
-        svg.append(mkText(pos, TINY_TXT_SIZE, x, tot_h-40, color=color))
-      if "FORM" in self.fields:
-        svg.append(mkText(form, NORMAL_TXT_SIZE, x, tot_h-25, color=color))
-      if "LEMMA" in self.fields:
-        svg.append(mkText(
-          lemma, SMALL_TXT_SIZE, x, tot_h-13, color=color, style="italic"))
-      if "ID" in self.fields:
-        svg.append(mkText(id, SMALL_TXT_SIZE, x, tot_h, color=color))
+      form = token.FORM
+      lemma = token.LEMMA
+      id = token.ID
+
+      if "UPOS" in fields or "XPOS" in fields:
+        yield mkText(pos, TINY_TXT_SIZE, x, tot_h-40)
+      if "FORM" in fields:
+        yield mkText(form, NORMAL_TXT_SIZE, x, tot_h-25)
+      if "LEMMA" in fields:
+        yield mkText(lemma, SMALL_TXT_SIZE, x, tot_h-13, style="italic")
+      if "ID" in fields:
+        yield mkText(id, SMALL_TXT_SIZE, x, tot_h)
 
     # draw deprels (arcs + labels)
     for ((src,trg),label) in self.deprels:   
-      dxy = self.token_dist(src, trg)
-      ndxy = 100 * 0.5 * self.arc_height(src,trg)
+      # arc endpoints are looked up once, straight from the precomputed tables
+      a, b = min(src,trg), max(src,trg)
+      dxy = xpos_table[b] - xpos_table[a]
+      ndxy = 100 * 0.5 * arc_heights[(a,b)]
       w = dxy - (600 * 0.5) / dxy
       h = ndxy / (3 * 0.5)
       r = h / 2
-      x = self.token_xpos(min(src,trg)) + (dxy/2) + (20 if trg < src else 10)
+      x = xpos_table[a] + (dxy/2) + (20 if trg < src else 10)
       y = ARC_BASE_YPOS
       x1 = x - w / 2
       x2 = min(x, (x1 + r))
@@ -260,54 +282,92 @@ class VisualStanza:
       y2 = ycorrect(y + r)
 
       # draw arc
-      arc_path = Path(stroke=color, fill="none")
-      arc_path.M(x1, y1).Q(x1, y2, x2, y2).L(x3,y2).Q(x4, y2, x4, y1)
-      if "HEAD" in self.fields:
-        svg.append(arc_path)
+      if "HEAD" in fields:
+        yield ("path", path_data(
+          ("M", x1, y1), ("Q", x1, y2, x2, y2), 
+          ("L", x3, y2), ("Q", x4, y2, x4, y1)), "none")
 
       # draw arrow
       x_arr = x + (w / 2) if trg < src else x - (w / 2)
       y_arr = ycorrect(y)
-      arrow = Lines(
-        x_arr, y_arr, 
-        x_arr - 3, y_arr - 6, 
-        x_arr + 3, y_arr - 6, 
-        stroke=color, fill=color, close="true")
-      if "HEAD" in self.fields:
-        svg.append(arrow)
+      if "HEAD" in fields:
+        yield ("path", path_data(
+          ("M", x_arr, y_arr), 
+          ("L", x_arr - 3, y_arr - 6), 
+          ("L", x_arr + 3, y_arr - 6), 
+          ("Z",)), "stroke")
 
       # draw label
       x_lab = x - (len(label) * 4.5 / 2)
       y_lab = ycorrect((h / 2) + ARC_BASE_YPOS + 3)
-      if "DEPREL" in self.fields:
-        svg.append(mkText(label, TINY_TXT_SIZE, x_lab, y_lab, color=color))
+      if "DEPREL" in fields:
+        yield mkText(label, TINY_TXT_SIZE, x_lab, y_lab)
 
     # draw root arrow & text
-    x_root_line = self.token_xpos(self.root) + 15
+    x_root_line = xpos_table[self.root] + 15
     y_root_line = ycorrect(tot_h)
     root_len = tot_h - ARC_BASE_YPOS
-    root_line = Line(
-      x_root_line, y_root_line, 
-      x_root_line, y_root_line + root_len, 
-      stroke=color)
     if "HEAD" in fields:
-      svg.append(root_line)
       arrow_endpoint = y_root_line + root_len
-      root_arrow = Lines(
-        x_root_line, arrow_endpoint, 
-        x_root_line - 3, arrow_endpoint - 6, 
-        x_root_line + 3, arrow_endpoint - 6, 
-        stroke=color, fill=color, close="true")
-      svg.append(root_arrow)
-    if "DEPREL" in self.fields:
-      svg.append(mkText(
+      yield ("path", path_data(
+        ("M", x_root_line, y_root_line), 
+        ("L", x_root_line, arrow_endpoint)), None)
+      yield ("path", path_data(
+        ("M", x_root_line, arrow_endpoint), 
+        ("L", x_root_line - 3, arrow_endpoint - 6), 
+        ("L", x_root_line + 3, arrow_endpoint - 6),
+        ("Z",)), "stroke")
+    if "DEPREL" in fields:
+      yield mkText(
         self.root_label, 
         TINY_TXT_SIZE, 
-        x_root_line + 5, ycorrect(tot_h - 15), 
-        color=color))
+        x_root_line + 5, ycorrect(tot_h - 15))
 
+  def to_svg(self, color="white"):
+    """generate svg tree code"""
+    tot_w, tot_h = self._dimensions()
+    svg = Drawing(tot_w,tot_h, origin=(0,0))
+    svg_append = svg.append
+    for (kind, *args) in self._elements(tot_w, tot_h):
+      if kind == "text":
+        (txt, size, x, y, style, weight) = args
+        svg_append(Text(
+          txt, 
+          size, 
+          x=x, y=y, 
+          fill=color, 
+          font_style=style, font_weight=weight
+        ))
+      else:
+        (d, fill) = args
+        svg_append(Path(
+          d, stroke=color, fill=color if fill == "stroke" else fill))
     return svg
 
+  def to_svg_str(self, color="white"):
+    """generate svg tree code as a stream of strings, without building an
+    intermediate drawsvg Drawing (same output as to_svg().as_svg(), except
+    that the color is XML-escaped)"""
+    tot_w, tot_h = self._dimensions()
+    color = escape(color, {'"': "&quot;"})
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield ('<svg xmlns="http://www.w3.org/2000/svg" '
+           'xmlns:xlink="http://www.w3.org/1999/xlink"\n     '
+           'width="{0}" height="{1}" viewBox="0 0 {0} {1}">\n'
+           '<defs>\n</defs>\n').format(tot_w, tot_h)
+    for (kind, *args) in self._elements(tot_w, tot_h):
+      if kind == "text":
+        (txt, size, x, y, style, weight) = args
+        yield ('<text x="{}" y="{}" font-size="{}" fill="{}" '
+               'font-style="{}" font-weight="{}">{}</text>\n').format(
+                 x, y, size, color, style, weight, escape(txt))
+      else:
+        (d, fill) = args
+        fill_attr = "" if fill is None else ' fill="{}"'.format(
+          color if fill == "stroke" else fill)
+        yield '<path d="{}" stroke="{}"{} />\n'.format(d, color, fill_attr)
+    yield "</svg>"
+
 def conll2svg(
   intxt: str, 
   color: str="white", 
@@ -327,8 +387,7 @@ def conll2svg(
           yield "<h4><b>{}</b>: {}</h4>".format(item, vstanza.metadict[item])
     if html_wrap: yield "<div>"
     try:
-      svg = vstanza.to_svg(color=color)
-      yield svg.as_svg()
+      yield "".join(vstanza.to_svg_str(color=color))
     except Exception as e:
       if html_wrap: yield "This tree cannot be visualized; check the format!" + str(e)
       sys.stderr.write(